@@ -2,21 +2,40 @@
 # All Rights Reserved.
 #
 # @author: Kevin Benton
+from __future__ import print_function
+
 import argparse
-import collections
+import errno
+import hashlib
 import json
 import netaddr
 import os
-import tempfile
+import pipes
+import Queue
 import re
+import select
+import shutil
+import string
 import subprocess
+import sys
+import tempfile
 import time
 import threading
 import urllib2
 try:
     import yaml
+    # use the libyaml parser when PyYAML was built with it
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
 except:
     pass
+# optional, reuses connections to the download host when available
+try:
+    import requests
+except ImportError:
+    requests = None
 
 # Arbitrary identifier printed in output to make tracking easy
 BRANCH_ID = 'master'
@@ -52,8 +71,62 @@ HORIZON_PATHS_TO_COPY = (
     'openstack_dashboard/dashboards/admin/connections',
     'openstack_dashboard/dashboards/project/connections')
 
+# shell commands copying each of the above from the extracted tgz in $TGT to
+# the horizon install at %(base_dir)s. folders are copied into their parent
+# and top level files into base_dir itself.
+HORIZON_COPY_COMMANDS = ''.join(
+    'yes | cp -rfp "$TGT/%s" "%%(base_dir)s/%s";'
+    % (path, path.rsplit('/', 1)[0] + '/' if '/' in path else '/')
+    for path in HORIZON_PATHS_TO_COPY)
+
+# marker printed before the stdout and stderr of each command when several
+# commands are batched into a single remote invocation
+BATCH_MARKER = '----bigpatch-batch %s %s----'
+BATCH_MARKER_RE = re.compile(r'\n----bigpatch-batch (\S+) (out|err)----\n')
+
+# start of the error reported by TimedCommand when a command times out
+TIMED_OUT_ERROR = 'Timed out waiting for command'
+
+# bond modes accepted on the command line and their linux bonding mode numbers
+BOND_MODES = {'xor': 2, 'round-robin': 0}
+
+# characters allowed in the neutron cluster name
+NEUTRON_ID_RE = re.compile(r'^[A-Za-z0-9._-]*$')
+
+# script installed on the nodes by the manifest to merge ini settings
+INI_APPLY_SCRIPT = '/var/lib/bigpatch/ini_apply.sh'
+
+# starts rabbitmq and restarts the app once if the node is partitioned. only
+# prints the partitions if they are still there after the restart.
+RABBIT_PARTITION_CHECK = r'''
+service rabbitmq-server start >/dev/null 2>&1
+partitions() { rabbitmqctl cluster_status | grep partitions | grep -v '\[\]'; }
+if partitions >/dev/null; then
+    rabbitmqctl stop_app >/dev/null
+    rabbitmqctl start_app >/dev/null
+    partitions
+fi'''
+
+# warnings from facter that don't matter when checking the puppet output
+HARMLESS_FACTER_ERRORS_RE = re.compile(
+    r'Device.*does not exist\.|Unable to add resolve nil for fact|'
+    r'ls: cannot access /dev/s')
+
+# interface error counters reported by ifconfig
+IFCONFIG_TX_ERRORS_RE = re.compile(r"TX packets:\d+ errors:(\d+) "
+                                   r"dropped:\d+ overruns:(\d+) "
+                                   r"carrier:(\d+)")
+IFCONFIG_RX_ERRORS_RE = re.compile(r"RX packets:\d+ errors:(\d+) "
+                                   r"dropped:\d+ overruns:(\d+) "
+                                   r"frame:(\d+)")
+
 
 class TimedCommand(object):
+    # size of the chunks read from and written to the process pipes
+    chunk_size = 65536
+    # seconds a timed out process gets to exit after SIGTERM before SIGKILL
+    kill_delay = 5
+
     def __init__(self, cmd):
         self.cmd = cmd
         self.process = None
@@ -61,34 +134,123 @@ class TimedCommand(object):
         self.resp = None
         self.errors = None
 
-    def run(self, timeout=60, retries=0, shell=False):
+    def run(self, timeout=60, retries=0, shell=False, stdin=None):
         # if shell is True, the incoming command is expected to be a string
         # that has been properly escaped.
-        def target():
-            try:
-                self.process = subprocess.Popen(
-                    self.cmd, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE, shell=shell)
-            except Exception as e:
-                self.errors = 'Error opening process "%s": %s' % (self.cmd, e)
-                return
-            self.resp, self.errors = self.process.communicate()
-
-        thread = threading.Thread(target=target)
-        thread.start()
+        # if stdin is set, it is written to the standard input of the command.
+        try:
+            self.process = subprocess.Popen(
+                self.cmd,
+                stdin=subprocess.PIPE if stdin is not None else None,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                shell=shell)
+        except Exception as e:
+            self.errors = 'Error opening process "%s": %s' % (self.cmd, e)
+            return self.resp, self.errors
 
-        thread.join(timeout)
-        if thread.is_alive():
+        finished = self._communicate(stdin, time.time() + timeout)
+        if not finished:
             self.process.terminate()
-            thread.join()
+            # don't wait forever on a process that ignores SIGTERM
+            kill_at = time.time() + self.kill_delay
+            while self.process.poll() is None and time.time() < kill_at:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout,
+                     self.process.stderr):
+            if pipe and not pipe.closed:
+                pipe.close()
+        if not finished:
             if self.retries < retries:
                 self.retries += 1
-                return self.run(timeout, retries)
-            self.errors = (
-                "Timed out waiting for command '%s' to finish." % self.cmd)
+                return self.run(timeout, retries, shell, stdin)
+            self.errors = "%s '%s' to finish." % (TIMED_OUT_ERROR, self.cmd)
 
         return self.resp, self.errors
 
+    def _communicate(self, stdin, deadline):
+        # Same as Popen.communicate() but gives up at the deadline, which
+        # avoids needing a separate thread to enforce the timeout. Returns
+        # False if the process hadn't exited and closed stdout by then.
+        stdout = self.process.stdout.fileno()
+        stderr = self.process.stderr.fileno()
+        output = {stdout: [], stderr: []}
+        readers = [stdout, stderr]
+        writers = []
+        written = 0
+        if stdin is not None:
+            writers.append(self.process.stdin.fileno())
+        while readers or writers:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if stdout not in readers:
+                # Background children can keep stderr open after the process
+                # exits, e.g. the ssh master started by ControlPersist. Once
+                # stdout is closed, stop as soon as the process has exited
+                # and nothing is left to read.
+                if (not writers and self.process.poll() is not None and
+                        not select.select(readers, [], [], 0)[0]):
+                    readers = []
+                    break
+                remaining = min(remaining, 0.1)
+            ready_readers, ready_writers, _ = select.select(
+                readers, writers, [], remaining)
+            for fd in ready_writers:
+                try:
+                    written += os.write(
+                        fd, stdin[written:written + self.chunk_size])
+                except OSError as e:
+                    # the process exited without reading everything
+                    if e.errno != errno.EPIPE:
+                        raise
+                    written = len(stdin)
+                if written >= len(stdin):
+                    self.process.stdin.close()
+                    writers.remove(fd)
+            for fd in ready_readers:
+                data = os.read(fd, self.chunk_size)
+                if data:
+                    output[fd].append(data)
+                else:
+                    readers.remove(fd)
+        self.resp = ''.join(output[stdout])
+        self.errors = ''.join(output[stderr])
+        return not (readers or writers)
+
+
+def run_concurrently(target, items, max_threads=MAX_THREADS):
+    # Calls target(item) for every item using up to max_threads worker
+    # threads. Each worker picks up the next item as soon as it is done so a
+    # slow item never holds up the rest. Returns a list of (item, exc_info)
+    # for every call that raised so the caller can re-raise it with the
+    # original traceback.
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                target(item)
+            except Exception:
+                errors.append((item, sys.exc_info()))
+
+    workers = [threading.Thread(target=worker)
+               for i in range(min(max_threads, pending.qsize()))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return errors
+
 
 class Environment(object):
 
@@ -102,12 +264,17 @@ class Environment(object):
     debug = False
     bond_mode = 2
 
-    def run_command_on_node(self, node, command, timeout=60, retries=0, shell=False):
+    def run_command_on_node(self, node, command, timeout=60, retries=0,
+                            stdin=None):
         raise NotImplementedError()
 
-    def copy_file_to_node(self, node, local_path, remote_path):
+    def copy_contents_to_node(self, node, contents, remote_path):
         raise NotImplementedError()
 
+    def cleanup(self):
+        # releases anything held open for the nodes during the deployment
+        pass
+
     @property
     def network_vlan_ranges(self):
         raise NotImplementedError()
@@ -130,9 +297,8 @@ class Environment(object):
 
     def set_bigswitch_servers(self, servers):
         for s in servers.split(','):
-            try:
-                int(s.split(':')[1])
-            except:
+            host, sep, port = s.partition(':')
+            if not sep or not port.strip().isdigit():
                 raise Exception('Invalid server "%s".\n'
                                 'Format should be ip:port' % s)
         self.bigswitch_servers = servers
@@ -143,17 +309,62 @@ class Environment(object):
                             'Format should be user:pass' % auth)
         self.bigswitch_auth = auth
 
+    def clean_bridge_mappings(self, node, bridge_mappings):
+        cleaned = []
+        for m in bridge_mappings.rstrip(',').split(','):
+            physnet, sep, bridge = m.partition(':')
+            if not sep or ':' in bridge:
+                raise Exception('Invalid bridge_mappings setting for node %s. '
+                                'bridge_mappings should be a comma-separated '
+                                'list of physnetName:bridgeName pairs.\n'
+                                'Input -> %s ' % (node, bridge_mappings))
+            cleaned.append(m.strip())
+        return ','.join(cleaned)
+
     def set_extra_template_params(self, dictofparams):
         self.extra_template_params = dictofparams
 
     def set_offline_mode(self, offline_mode):
         self.offline_mode = offline_mode
 
-    def get_node_python_package_path(self, node, package):
-        com = ("\"python -c 'import %s;import os;print "
-               "os.path.dirname(%s.__file__)'\""
-               % (package, package))
-        resp, errors = self.run_command_on_node(node, com, shell=True)
+    def run_commands_on_node(self, node, commands, timeout=60):
+        # Runs several independent commands in a single remote invocation so
+        # only one connection is made. commands is a list of (key, command)
+        # pairs and a dict of key -> (resp, errors) is returned.
+        script = ['BATCH_ERR=$(mktemp)']
+        for key, command in commands:
+            script.append("printf '\\n%s\\n'" % (BATCH_MARKER % (key, 'out')))
+            script.append('{ %s\n} 2>"$BATCH_ERR"' % command)
+            script.append("printf '\\n%s\\n'" % (BATCH_MARKER % (key, 'err')))
+            script.append('cat "$BATCH_ERR"')
+        script.append('rm -f "$BATCH_ERR"')
+        resp, errors = self.run_command_on_node(node, '\n'.join(script),
+                                                timeout)
+        # split result is [preamble, key, kind, output, key, kind, output...]
+        sections = BATCH_MARKER_RE.split(resp or '')
+        results = dict((key, ['', '']) for key, command in commands)
+        finished = set()
+        for i in range(1, len(sections) - 2, 3):
+            key, kind, output = sections[i:i + 3]
+            results[key][kind == 'err'] = output
+            if kind == 'err':
+                finished.add(key)
+        # a command only finished if its err marker was printed. anything
+        # after the point the batch timed out or died never ran, so report it
+        # instead of passing on empty output.
+        unfinished = [name for name, cmd in commands if name not in finished]
+        if unfinished or TIMED_OUT_ERROR in (errors or ''):
+            raise Exception("Error running commands on node %s. Commands not "
+                            "completed: %s\n%s\n%s"
+                            % (node, ', '.join(unfinished) or 'none',
+                               errors, resp))
+        return dict((key, tuple(val)) for key, val in results.items())
+
+    def get_python_package_path_command(self, package):
+        return ("python -c 'import %s;import os;print "
+                "os.path.dirname(%s.__file__)'" % (package, package))
+
+    def parse_python_package_path(self, node, package, resp, errors):
         if errors or not resp.strip() or len(resp.strip().splitlines()) > 1:
             if 'ImportError' in errors:
                 return False
@@ -170,69 +381,110 @@ class SSHEnvironment(Environment):
         self.ssh_user = 'root'
         self.ssh_password = None
         self.sshpass_detected = False
+        # nodes that have already passed ensure_connectivity
+        self.connected_nodes = set()
+        # holds the ssh master connection sockets so every command to a node
+        # reuses one authenticated connection instead of opening its own.
+        # ControlPersist needs OpenSSH 5.6 or newer and older clients reject
+        # the option outright, so sharing is only used if ssh accepts it.
+        self.control_dir = None
+        resp, errors = TimedCommand(
+            ['ssh', '-oControlPersist=yes', '-V']).run()
+        if 'OpenSSH' in (errors or ''):
+            self.control_dir = tempfile.mkdtemp(prefix='bigpatch-ssh-')
         super(SSHEnvironment, self).__init__(*args, **kwargs)
 
-    def copy_file_to_node(self, node, local_path, remote_path):
-        sshcomm = ["scp", '-o LogLevel=quiet', local_path,
-                   "%s@%s:%s" % (self.ssh_user, node, remote_path)]
+    def set_ssh_password(self, ssh_password):
+        if ssh_password and not self.sshpass_detected:
+            # we need to see if sshpass is installed
+            resp, errors = TimedCommand(['sshpass', '-h']).run()
+            if errors:
+                raise Exception(
+                    "Error running 'sshpass'. 'sshpass' must be installed "
+                    "to use password based authentication.\n%s" % errors)
+            self.sshpass_detected = True
+        self.ssh_password = ssh_password
+
+    def _ssh_prefix(self, node):
+        # common start of every ssh command line sent to the nodes
+        sshcomm = ['ssh', '-oStrictHostKeyChecking=no']
+        if self.control_dir:
+            sshcomm += ['-oControlMaster=auto', '-oControlPersist=600',
+                        '-oControlPath=%s' % self._control_path(node)]
         if self.ssh_password:
             sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
-        resp, errors = TimedCommand(sshcomm).run(timeout=180)
+        return sshcomm
+
+    def _control_path(self, node):
+        # a short fixed name per node keeps the path, plus the suffix ssh adds
+        # while creating the socket, under the unix socket length limit
+        return os.path.join(self.control_dir,
+                            hashlib.md5(node).hexdigest()[:16])
+
+    def cleanup(self):
+        # stop the master connections instead of leaving them to linger
+        # until ControlPersist expires
+        if self.control_dir:
+            for node in self.connected_nodes:
+                TimedCommand(['ssh',
+                              '-oControlPath=%s' % self._control_path(node),
+                              '-O', 'exit',
+                              "%s@%s" % (self.ssh_user, node)]).run()
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+        self.connected_nodes.clear()
+
+    def copy_contents_to_node(self, node, contents, remote_path):
+        # streams contents straight into the remote file so nothing has to be
+        # written locally first
+        sshcomm = self._ssh_prefix(node) + [
+            '-o LogLevel=quiet', "%s@%s" % (self.ssh_user, node),
+            "cat > %s" % remote_path]
+        resp, errors = TimedCommand(sshcomm).run(timeout=180, stdin=contents)
         return resp, errors
 
     def run_command_on_node(self, node, command, timeout=60, retries=0,
-                            shell=False):
+                            stdin=None):
         if self.debug:
-            print "[Node %s] Running command: %s" % (node, command)
-        sshcomm = [
-            "ssh", '-oStrictHostKeyChecking=no',
-            '-o LogLevel=quiet', "%s@%s" % (self.ssh_user, node),
-            command
-        ]
-        if self.ssh_password:
-            sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
-            if not self.sshpass_detected:
-                # we need to see if sshpass is installed
-                resp, errors = TimedCommand(['sshpass', '-h']).run()
-                if errors:
-                    raise Exception(
-                        "Error running 'sshpass'. 'sshpass' must be installed "
-                        "to use password based authentication.\n%s" % errors)
-                self.sshpass_detected = True
-        if shell:
-            sshcomm = ' '.join(sshcomm)
+            print("[Node %s] Running command: %s" % (node, command))
+        sshcomm = self._ssh_prefix(node) + [
+            '-o LogLevel=quiet', "%s@%s" % (self.ssh_user, node), command]
+        # the command is a single argument to ssh and is interpreted by the
+        # shell on the remote side so no local shell is needed
         self.ensure_connectivity(node)
-        resp, errors = TimedCommand(sshcomm).run(timeout, retries, shell=shell)
+        resp, errors = TimedCommand(sshcomm).run(timeout, retries,
+                                                 stdin=stdin)
         return resp, errors.replace("Error: NetworkManager is not running.", "")
 
     def ensure_connectivity(self, node):
-        # This might be worth caching if many SSH calls are made to each node.
-        sshcomm = [
-            "ssh", '-oStrictHostKeyChecking=no',
-            "%s@%s" % (self.ssh_user, node),
-            "echo hello"
-        ]
-        if self.ssh_password:
-            sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
+        if node in self.connected_nodes:
+            return
+        # LogLevel is left alone here so permission errors are reported
+        sshcomm = self._ssh_prefix(node) + [
+            "%s@%s" % (self.ssh_user, node), "echo hello"]
         resp, errors = TimedCommand(sshcomm).run(60, 4)
         if "Permission denied, please try again." in errors:
             raise Exception(
                 "Error: Received permission error on node %s. Verify that "
                 "the SSH password is correct or that the ssh key being used is "
-                "authorized on that host.")
+                "authorized on that host." % node)
         if not resp.strip() and errors:
-            print ("Warning: Errors when checking SSH connectivity for node "
-                   "%s:\n%s" % (node, errors))
+            print("Warning: Errors when checking SSH connectivity for node "
+                  "%s:\n%s" % (node, errors))
+        if resp.strip():
+            self.connected_nodes.add(node)
 
 
 class ConfigEnvironment(SSHEnvironment):
 
     network_vlan_ranges = None
 
-    def __init__(self, yaml_string, skip_nodes=[], specific_nodes=[]):
+    def __init__(self, yaml_stream, skip_nodes=(), specific_nodes=()):
         super(ConfigEnvironment, self).__init__()
+        # yaml_stream may be an open file, which is parsed as it is read, or
+        # a string
         try:
-            self.settings = yaml.load(yaml_string)
+            self.settings = yaml.load(yaml_stream, Loader=YamlLoader)
         except Exception as e:
             raise Exception("Error loading from yaml file:\n%s" % e)
         if not isinstance(self.settings.get('nodes'), list):
@@ -246,42 +498,30 @@ class ConfigEnvironment(SSHEnvironment):
                           if n['hostname'] not in skip_nodes and
                           (not specific_nodes or
                            n['hostname'] in specific_nodes)]
+            self.node_settings = dict((n['hostname'], n)
+                                      for n in self.settings['nodes'])
         except KeyError:
             raise Exception('missing hostname in nodes %s'
                             % self.settings['nodes'])
 
     def get_node_bond_interfaces(self, node):
-        for n in self.settings['nodes']:
-            if n['hostname'] == node:
-                return [i for i in n.get('bond_interfaces', '').split(',')
-                        if i]
-        print 'Node %s has no bond interfaces.' % node
+        if node in self.node_settings:
+            return [i for i in self.node_settings[node].get(
+                'bond_interfaces', '').split(',') if i]
+        print('Node %s has no bond interfaces.' % node)
         return []
 
     def get_node_bridge_mappings(self, node):
-        br_mappings = None
-        for n in self.settings['nodes']:
-            if n['hostname'] == node:
-                br_mappings = n.get('bridge_mappings')
+        br_mappings = self.node_settings.get(node, {}).get('bridge_mappings')
         if not br_mappings:
             raise Exception('Node %s is missing bridge_mappings '
                             'which is required for the OVS agent.'
                             % node)
-        cleaned = []
-        for m in br_mappings.rstrip(',').split(','):
-            if len(m.split(':')) != 2:
-                raise Exception('Invalid bridge_mappings setting for node %s. '
-                                'bridge_mappings should be a comma-separated '
-                                'list of physnetName:bridgeName pairs.\n'
-                                'Input -> %s ' % (br_mappings))
-            cleaned.append(m.strip())
-        return ','.join(cleaned)
+        return self.clean_bridge_mappings(node, br_mappings)
 
     def get_node_phy_bridge(self, node):
-        phy_br = None
-        for n in self.settings['nodes']:
-            if n['hostname'] == node:
-                phy_br = n.get('physical_interface_bridge')
+        phy_br = self.node_settings.get(node, {}).get(
+            'physical_interface_bridge')
         if not phy_br:
             raise Exception('Node %s is missing physical_interface_bridge '
                             'which is required for bonding configuration.'
@@ -291,13 +531,15 @@ class ConfigEnvironment(SSHEnvironment):
 
 class FuelEnvironment(SSHEnvironment):
 
-    def __init__(self, environment_id, skip_nodes=[], specific_nodes=[]):
+    def __init__(self, environment_id, skip_nodes=(), specific_nodes=()):
         self.node_settings = {}
+        # cache of _get_bond_bridge results for each node
+        self._bond_bridges = {}
         self.nodes = []
         self.settings = {}
         super(FuelEnvironment, self).__init__()
         try:
-            print "Retrieving general Fuel settings..."
+            print("Retrieving general Fuel settings...")
             output, errors = TimedCommand(
                 ["fuel", "--json", "--env", str(environment_id),
                  "settings", "-d"]).run()
@@ -313,12 +555,13 @@ class FuelEnvironment(SSHEnvironment):
             raise Exception("Could not download fuel settings: %s"
                             % output)
         try:
-            self.settings = json.loads(open(path, 'r').read())
+            with open(path, 'r') as fh:
+                self.settings = json.load(fh)
         except Exception as e:
             raise Exception("Error parsing fuel json settings.\n%s" % e)
 
         # grab list of hosts
-        print "Retrieving list of Fuel nodes..."
+        print("Retrieving list of Fuel nodes...")
         output, errors = TimedCommand(
             ["fuel", "nodes", "--env", str(environment_id)]).run()
         if errors:
@@ -331,21 +574,32 @@ class FuelEnvironment(SSHEnvironment):
                      for l in lines]
             self.nodes = [n for n in nodes if n not in skip_nodes and
                           (not specific_nodes or n in specific_nodes)]
-            print "Nodes to configure: %s" % self.nodes
+            print("Nodes to configure: %s" % self.nodes)
         except IndexError:
             raise Exception("Could not parse node list:\n%s" % output)
-        for node in self.nodes:
+
+        def load_node_config(node):
             self.node_settings[node] = self.get_node_config(node)
 
+        errors = run_concurrently(load_node_config, self.nodes)
+        if errors:
+            node, exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        # the vlan ranges are the same for every node so build them once
+        self._network_vlan_ranges = self._build_network_vlan_ranges()
+        # NOTE: only one used network vlan range supported for now
+        self._first_physnet = (
+            self._network_vlan_ranges.split(',')[0].split(':')[0])
+
     def get_node_config(self, node):
-        print "Retrieving Fuel configuration for node %s..." % node
+        print("Retrieving Fuel configuration for node %s..." % node)
         resp, errors = self.run_command_on_node(node, 'cat /etc/astute.yaml')
         if errors or not resp:
             raise Exception("Error retrieving config for node %s:\n%s\n"
                             "Is the node online?"
                             % (node, errors))
         try:
-            conf = yaml.load(resp)
+            conf = yaml.load(resp, Loader=YamlLoader)
         except Exception as e:
             raise Exception("Error parsing node yaml file:\n%s\n%s"
                             % (e, resp))
@@ -353,7 +607,12 @@ class FuelEnvironment(SSHEnvironment):
 
     @property
     def network_vlan_ranges(self):
+        return self._network_vlan_ranges
+
+    def _build_network_vlan_ranges(self):
         net_vlans = []
+        if not self.node_settings:
+            return ''
         # comes from compute settings file
         node = self.node_settings.keys()[0]
         physnets = self.node_settings[node][
@@ -365,18 +624,21 @@ class FuelEnvironment(SSHEnvironment):
             net_vlans.append('%s:%s' % (physnet, vrange))
         return ','.join(net_vlans)
 
-    def get_node_bond_interfaces(self, node):
-        if node not in self.nodes:
+    def _get_node_transformations(self, node):
+        if node not in self.node_settings:
             raise Exception('No node in fuel environment %s' % node)
-        trans = self.node_settings[node]['network_scheme']['transformations']
-        bond_bridge = self._get_bond_bridge(trans)
+        return self.node_settings[node]['network_scheme']['transformations']
+
+    def get_node_bond_interfaces(self, node):
+        trans = self._get_node_transformations(node)
+        bond_bridge = self._get_node_bond_bridge(node)
         for t in trans:
             if t.get('action') == 'add-bond':
                 # skip the bond if it's not on the bridge with br-prv
                 if bond_bridge and t.get('bridge') != bond_bridge:
                     continue
                 return t.get('interfaces', [])
-        print 'Node %s has no bond interfaces.' % node
+        print('Node %s has no bond interfaces.' % node)
         return []
 
     def _get_bond_bridge(self, transformations):
@@ -387,13 +649,17 @@ class FuelEnvironment(SSHEnvironment):
                     and 'br-prv' in t.get('bridges', [])):
                 return list(set(t.get('bridges')) - set(['br-prv']))[0]
 
+    def _get_node_bond_bridge(self, node):
+        if node not in self._bond_bridges:
+            self._bond_bridges[node] = self._get_bond_bridge(
+                self._get_node_transformations(node))
+        return self._bond_bridges[node]
+
     def get_node_phy_bridge(self, node):
         bridge = None
-        if node not in self.nodes:
-            raise Exception('No node in fuel environment %s' % node)
-        trans = self.node_settings[node]['network_scheme']['transformations']
+        trans = self._get_node_transformations(node)
         # first try looking for br-prv
-        bridge = self._get_bond_bridge(trans)
+        bridge = self._get_node_bond_bridge(node)
         if bridge:
             return bridge
         for t in trans:
@@ -404,12 +670,10 @@ class FuelEnvironment(SSHEnvironment):
         return bridge
 
     def get_node_bridge_mappings(self, node):
-        if node not in self.nodes:
+        if node not in self.node_settings:
             raise Exception('No node in fuel environment %s' % node)
-        # NOTE: only one used network vlan range supported for now
-        physnet = self.network_vlan_ranges.split(',')[0].split(':')[0]
         bridge = self.node_settings[node]['network_scheme']['roles']['private']
-        return '%s:%s' % (physnet, bridge)
+        return '%s:%s' % (self._first_physnet, bridge)
 
 
 class StandaloneEnvironment(Environment):
@@ -434,35 +698,37 @@ class StandaloneEnvironment(Environment):
     def get_node_bridge_mappings(self, node):
         if not self.bridge_mappings:
             raise Exception("Missing bridge_mappings setting")
-        cleaned = []
-        for m in self.bridge_mappings.rstrip(',').split(','):
-            if len(m.split(':')) != 2:
-                raise Exception('Invalid bridge_mappings setting for node %s. '
-                                'bridge_mappings should be a comma-separated '
-                                'list of physnetName:bridgeName pairs.\n'
-                                'Input -> %s ' % (self.bridge_mappings))
-            cleaned.append(m.strip())
-        return ','.join(cleaned)
+        return self.clean_bridge_mappings(node, self.bridge_mappings)
 
-    def copy_file_to_node(self, node, local_path, remote_path):
-        resp, errors = TimedCommand(
-            ['bash', '-lc', "cp %s %s" % (local_path, remote_path)]).run()
-        return resp, errors
+    def copy_contents_to_node(self, node, contents, remote_path):
+        try:
+            with open(os.path.expanduser(remote_path), 'wb') as fh:
+                fh.write(contents)
+        except IOError as e:
+            return '', str(e)
+        return '', ''
 
     def run_command_on_node(self, node, command, timeout=60, retries=0,
-                            shell=False):
-        resp, errors = TimedCommand(['bash', '-lc', command]).run(timeout,
-                                                                  retries)
-        return resp, errors
+                            stdin=None):
+        resp, errors = TimedCommand(['bash', '-lc', command]).run(
+            timeout, retries, stdin=stdin)
+        return resp or '', errors
 
 
 class ConfigDeployer(object):
+    # patch archive contents by url, shared by every deployer so an archive
+    # is only loaded or downloaded once per process
+    patch_file_cache = {}
+    patch_file_cache_lock = threading.Lock()
+
     def __init__(self, environment, openstack_release,
-                 patch_python_files=True):
+                 patch_python_files=True, concurrency=MAX_THREADS):
         self.env = environment
         self.os_release = openstack_release.lower()
         self.patch_python_files = patch_python_files
-        self.patch_file_cache = {}
+        # maximum number of nodes deployed to at the same time
+        self.concurrency = concurrency
+        self.nodes_information_lock = threading.Lock()
         if any([not self.env.bigswitch_auth,
                 not self.env.bigswitch_servers,
                 not self.env.nodes]):
@@ -470,10 +736,10 @@ class ConfigDeployer(object):
                             'and controller options')
         if self.patch_python_files:
             if self.env.offline_mode:
-                print 'Loading offline files...'
+                print('Loading offline files...')
                 for patch in (NEUTRON_TGZ_PATH[self.os_release],
                               HORIZON_TGZ_PATH[self.os_release]):
-                    if not patch:
+                    if not patch or patch[0] in self.patch_file_cache:
                         continue
                     try:
                         with open(os.path.join(os.path.dirname(__file__),
@@ -486,34 +752,39 @@ class ConfigDeployer(object):
                                         (patch[0], patch[1], str(e)))
                     self.patch_file_cache[patch[0]] = contents
             else:
-                print 'Downloading patch files...'
-                for lib in (NEUTRON_TGZ_PATH[self.os_release],
-                            HORIZON_TGZ_PATH[self.os_release]):
-                    if not lib:
-                        continue
-                    url = lib[0]
-                    try:
-                        body = urllib2.urlopen(url).read()
-                    except Exception as e:
-                        raise Exception("Error encountered while trying to "
-                                        "download patch file at %s.\n%s"
-                                        % (url, e))
-                    self.patch_file_cache[url] = body
+                print('Downloading patch files...')
+                urls = [lib[0] for lib in (NEUTRON_TGZ_PATH[self.os_release],
+                                           HORIZON_TGZ_PATH[self.os_release])
+                        if lib and lib[0] not in self.patch_file_cache]
+                # one session is shared by all downloads so connections to
+                # the same host are reused
+                session = requests.Session() if requests else None
+                errors = run_concurrently(
+                    lambda url: self.download_patch_file(url, session), urls)
+                if errors:
+                    url, exc_info = errors[0]
+                    raise Exception("Error encountered while trying to "
+                                    "download patch file at %s.\n%s"
+                                    % (url, exc_info[1]))
+
+    def download_patch_file(self, url, session=None):
+        if session:
+            response = session.get(url, timeout=60)
+            response.raise_for_status()
+            body = response.content
+        else:
+            body = urllib2.urlopen(url).read()
+        with self.patch_file_cache_lock:
+            self.patch_file_cache[url] = body
 
     def deploy_to_all(self):
-        thread_list = collections.deque()
-        errors = []
         nodes_information = []
-        for node in self.env.nodes:
-            t = threading.Thread(target=self.deploy_to_node_catch_errors,
-                                 args=(node, errors, nodes_information))
-            thread_list.append(t)
-            t.start()
-            if len(thread_list) >= MAX_THREADS:
-                top = thread_list.popleft()
-                top.join()
-        for thread in thread_list:
-            thread.join()
+        try:
+            errors = run_concurrently(
+                lambda node: self.deploy_to_node(node, nodes_information),
+                self.env.nodes, max_threads=self.concurrency)
+        finally:
+            self.env.cleanup()
         # sanity checks across collected info
         # make sure neutron servers are all pointing to the same DB
         conn_strings = [info['neutron_connection']
@@ -523,43 +794,69 @@ class ConfigDeployer(object):
             strings_with_nodes = ["%s: %s" % (node, info['neutron_connection'])
                                   for (node, info) in nodes_information
                                   if info.get('neutron_connection')]
-            print ("Warning: different neutron connection strings detected on "
-                   "neutron server nodes. They should all reference the same "
-                   "database.\nConnections:\n%s" % "\n".join(strings_with_nodes))
+            print("Warning: different neutron connection strings detected on "
+                  "neutron server nodes. They should all reference the same "
+                  "database.\nConnections:\n%s" % "\n".join(strings_with_nodes))
         # make sure they are all using unique lldpd hostname values
         node_names = [(node, info['lldp_name'])
                       for (node, info) in nodes_information
                       if info.get('lldp_name')]
         lldp_names = map(lambda x: x[1], node_names)
         if len(set(lldp_names)) != len(lldp_names):
-            print ("Warning: multiple nodes are using the same neutron host "
-                   "identifiers, which will result in them being placed into "
-                   "the same fabric port group. This will prevent traffic "
-                   "from being forwarded correctly to either node. Here are "
-                   "the neutron host IDs for each node.\n%s" % '\n'.join(
-                       ['%s => %s' % pair for pair in node_names]))
+            print("Warning: multiple nodes are using the same neutron host "
+                  "identifiers, which will result in them being placed into "
+                  "the same fabric port group. This will prevent traffic "
+                  "from being forwarded correctly to either node. Here are "
+                  "the neutron host IDs for each node.\n%s" % '\n'.join(
+                      ['%s => %s' % pair for pair in node_names]))
 
         if errors:
-            print "Encountered errors while deploying patch to nodes."
-            for node, error in errors:
-                print "Error on node %s:\n%s" % (node, error)
+            print("Encountered errors while deploying patch to nodes.")
+            for node, exc_info in errors:
+                print("Error on node %s:\n%s" % (node, exc_info[1]))
         else:
-            print "Deployment Complete!"
-
-    def deploy_to_node_catch_errors(self, node, error_log, nodes_information):
-        try:
-            self.deploy_to_node(node, nodes_information)
-        except Exception as e:
-            error_log.append((node, str(e)))
-
-    def get_lldp_advertisement_hostname(self, node):
+            print("Deployment Complete!")
+
+    def probe_node(self, node, bond_interfaces):
+        # Gathers everything deploy_to_node needs to inspect on the node
+        # with a single remote invocation instead of one per check.
+        commands = [('ifconfig:%s' % bondint, 'ifconfig %s' % bondint)
+                    for bondint in bond_interfaces]
+        commands.append(('agent_hosts',
+                         "grep -R -e '^host\s*=' /etc/neutron/"))
+        commands.append(('neutron_path',
+                         self.env.get_python_package_path_command('neutron')))
+        commands.append(('neutron_connection',
+                         "grep -m1 -e '^connection' "
+                         "/etc/neutron/neutron.conf"))
+        commands.append(('crudini', 'command -v crudini'))
+        commands.append(('keystone_certs',
+                         "grep -E '^(ca_certs|certfile)[[:space:]]*=' "
+                         "/etc/keystone/keystone.conf"))
+        if self.patch_python_files:
+            commands.append(
+                ('netaddr_path',
+                 self.env.get_python_package_path_command('netaddr')))
+            # try to find horizon. locate command isn't available on redhat
+            # so we make a guess at a well-known location in that case.
+            commands.append(
+                ('horizon_path',
+                 "updatedb 2>/dev/null && "
+                 "locate openstack_dashboard/dashboards/admin/dashboard.py "
+                 "| grep -v pyc || "
+                 "ls /usr/share/openstack-dashboard/openstack_dashboard/"
+                 "dashboards/admin/dashboard.py"))
+        # updatedb can take a few minutes on a large filesystem, so the batch
+        # gets more than the default timeout
+        return self.env.run_commands_on_node(node, commands, 300)
+
+    def get_lldp_advertisement_hostname(self, node, probe):
         # Determine what name lldpd should advertise for the hostname.
         # We need to match whatever the neutron agents are configured to
         # use. If they don't have anything configured, they will use the
         # result of 'uname -n' so we will use the same so we default to the
         # same.
-        resp, errors = self.env.run_command_on_node(
-            node, "grep -R -e '^host\s*=' /etc/neutron/")
+        resp, errors = probe['agent_hosts']
         if errors:
             raise Exception("error determining agent hostname information "
                             "on %s:\n%s" % (node, errors))
@@ -579,8 +876,9 @@ class ConfigDeployer(object):
         return '`uname -n`'
 
     def deploy_to_node(self, node, nodes_information):
-        print "Applying configuration to %s..." % node
+        print("Applying configuration to %s..." % node)
         bond_interfaces = self.env.get_node_bond_interfaces(node)
+        probe = self.probe_node(node, bond_interfaces)
         puppet_settings = {
             'bond_interfaces': ','.join(bond_interfaces),
             'neutron_id': self.env.neutron_id,
@@ -592,19 +890,20 @@ class ConfigDeployer(object):
                                                        False)
             ).lower(),
             'offline_mode': str(self.env.offline_mode).lower(),
-            'bond_mode': self.env.bond_mode
+            'bond_mode': self.env.bond_mode,
+            'use_crudini': bool(probe['crudini'][0].strip())
         }
         if bond_interfaces:
-            self.check_health_of_bond_interfaces(node, bond_interfaces)
-            lldp_name = self.get_lldp_advertisement_hostname(node)
+            self.check_health_of_bond_interfaces(node, bond_interfaces, probe)
+            lldp_name = self.get_lldp_advertisement_hostname(node, probe)
             puppet_settings['lldp_advertised_name'] = lldp_name
             puppet_settings['physical_bridge'] = self.env.get_node_phy_bridge(
                 node)
             physnets = self.env.network_vlan_ranges.split(',')
             if len(physnets) > 1:
-                print ('Warning, multiple physnets configured "%s". A '
-                       'bridge_mapping will only be configured for %s'
-                       % (physnets, physnets[0]))
+                print('Warning, multiple physnets configured "%s". A '
+                      'bridge_mapping will only be configured for %s'
+                      % (physnets, physnets[0]))
             puppet_settings['bridge_mappings'] = (
                 self.env.get_node_bridge_mappings(node))
             for key, val in enumerate(bond_interfaces):
@@ -615,14 +914,15 @@ class ConfigDeployer(object):
                 puppet_settings['bond_int1'] = bond_interfaces[0]
         ptemplate = PuppetTemplate(puppet_settings)
         ptemplate.settings['neutron_path'] = (
-            self.env.get_node_python_package_path(node, 'neutron'))
+            self.env.parse_python_package_path(node, 'neutron',
+                                               *probe['neutron_path']))
 
         if self.patch_python_files:
             # install neutron files from our fork
-            self.copy_neutron_files_to_node(node)
+            self.copy_neutron_files_to_node(node, probe)
 
             # patch openstack_dashboard if available
-            self.patch_horizon_if_installed(node)
+            self.patch_horizon_if_installed(node, probe)
 
         if not self.env.offline_mode:
             self.install_puppet_prereqs(node)
@@ -643,134 +943,164 @@ class ConfigDeployer(object):
                             % (node, errors))
 
         # run a few last sanity checks
+        certs = self.get_keystone_certs(probe)
         self.check_rabbit_cluster_partition_free(node)
-        self.cert_validity_check(node)
-        self.check_lldpd_running(node)
-        self.check_bond_int_speeds_match(node, bond_interfaces)
+        sanity = self.probe_sanity(node, bond_interfaces, certs)
+        self.cert_validity_check(node, certs, sanity)
+        self.check_lldpd_running(node, sanity)
+        self.check_bond_int_speeds_match(node, bond_interfaces, sanity)
 
         # aggregate node information to compare across other nodes
         node_info = {}
         # collect connection string for comparison with other neutron servers
-        connection_string = self.get_neutron_connection_string(node)
+        connection_string = self.get_neutron_connection_string(probe, sanity)
         if connection_string:
             node_info['neutron_connection'] = connection_string
         # collect static lldpd names to make sure they are all unique
         if ptemplate.settings['lldp_advertised_name'] != '`uname -n`':
             node_info['lldp_name'] = ptemplate.settings['lldp_advertised_name']
-        nodes_information.append((node, node_info))
-        print "Configuration applied to %s." % node
+        with self.nodes_information_lock:
+            nodes_information.append((node, node_info))
+        print("Configuration applied to %s." % node)
 
     def push_manifest_to_node(self, node, pbody):
         # pushes a puppet string to a remote node and returns the remote fname
-        f = tempfile.NamedTemporaryFile(delete=True)
-        f.write(pbody)
-        f.flush()
         remotefile = '~/generated_manifest.pp'
-        resp, errors = self.env.copy_file_to_node(node, f.name, remotefile)
+        resp, errors = self.env.copy_contents_to_node(node, pbody, remotefile)
         if errors:
             raise Exception("error pushing puppet manifest to %s:\n%s"
                             % (node, errors))
         return remotefile
 
     def install_puppet_prereqs(self, node):
+        # each install is skipped when a previous run already did it since
+        # they need network access and are the slowest part of a re-run
         self.env.run_command_on_node(
             node,
-            "yum -y remove facter && gem install puppet facter "
-            "--no-ri --no-rdoc")
+            "gem list -i puppet >/dev/null && gem list -i facter >/dev/null "
+            "|| { yum -y remove facter && gem install puppet facter "
+            "--no-ri --no-rdoc; }")
         self.env.run_command_on_node(node, "ntpdate pool.ntp.org")
         # stdlib is missing on 1404. install it and don't worry about return.
         # connectivity issues should be caught in the inifile install
         self.env.run_command_on_node(
-            node, "puppet module install puppetlabs-stdlib --force", 30, 2)
+            node, self.get_puppet_module_install_command('puppetlabs-stdlib'),
+            30, 2)
         resp, errors = self.env.run_command_on_node(
-            node, "puppet module install puppetlabs-inifile --force", 30, 2)
+            node, self.get_puppet_module_install_command('puppetlabs-inifile'),
+            30, 2)
         if errors:
             raise Exception("error installing puppet prereqs on %s:\n%s"
                             % (node, errors))
 
+    def get_puppet_module_install_command(self, module):
+        return ("puppet module list 2>/dev/null | grep -q '%s ' || "
+                "puppet module install %s --force" % (module, module))
+
     def eliminate_harmless_facter_errors(self, errors):
         # ignore bug in facter
-        actual_errors = []
-        errors = errors.splitlines()
-        for e in errors:
-            # ignore some warnings from facter that don't matter
-            if "Device" in e and "does not exist." in e:
-                continue
-            if "Unable to add resolve nil for fact" in e:
-                continue
-            if "ls: cannot access /dev/s" in e:
-                continue
-            actual_errors.append(e)
+        actual_errors = [e for e in errors.splitlines()
+                         if not HARMLESS_FACTER_ERRORS_RE.search(e)]
         return '\n'.join(actual_errors)
 
+    def probe_sanity(self, node, bond_interfaces, certs):
+        # Gathers everything the post-puppet sanity checks need with a single
+        # remote invocation.
+        commands = [
+            ('certs', "openssl verify %s" % ' '.join(pipes.quote(cert)
+                                                     for cert in certs)),
+            ('lldpd', 'pgrep -x lldpd'),
+            ('neutron_server', "pgrep -f '[n]eutron-server'")]
+        if bond_interfaces and self.env.check_interface_errors:
+            commands.extend(('ethtool:%s' % iface,
+                             "ethtool %s | grep Speed" % iface)
+                            for iface in bond_interfaces)
+        return self.env.run_commands_on_node(node, commands)
+
     def check_rabbit_cluster_partition_free(self, node):
-        self.env.run_command_on_node(node, "service rabbitmq-server start")
+        # restarting the rabbit app can be slow so this runs on its own with
+        # its own timeout instead of holding up the sanity batch
         resp, errors = self.env.run_command_on_node(
-            node, ("rabbitmqctl cluster_status | grep partitions | " +
-                   r"""grep -v '\[\]'"""))
-        if 'partitions' in resp:
-            self.env.run_command_on_node(node, "rabbitmqctl stop_app")
-            self.env.run_command_on_node(node, "rabbitmqctl start_app")
-            resp, errors = self.env.run_command_on_node(
-                node, ("rabbitmqctl cluster_status | grep partitions | " +
-                       r"""grep -v '\[\]'"""))
-            if 'partitions' in resp:
-                print ("Warning: RabbitMQ partition detected on node %s: %s "
-                       "Restart rabbitmq-server on each node in the parition."
-                       % (node, resp))
-
-    def check_lldpd_running(self, node):
+            node, RABBIT_PARTITION_CHECK, 180)
+        if TIMED_OUT_ERROR in errors:
+            print("Warning: timed out checking for a RabbitMQ partition on "
+                  "node %s." % node)
+        elif 'partitions' in resp:
+            print("Warning: RabbitMQ partition detected on node %s: %s "
+                  "Restart rabbitmq-server on each node in the parition."
+                  % (node, resp))
+
+    def check_lldpd_running(self, node, sanity):
         # check for lldpd
-        resp = self.env.run_command_on_node(
-            node, ('ps -ef | grep lldpd | grep -v grep'))[0]
+        resp = sanity['lldpd'][0]
         if not resp.strip():
-            print ("Warning: lldpd process not running on node %s. "
-                   "Automatic port groups will not be formed." % node)
+            print("Warning: lldpd process not running on node %s. "
+                  "Automatic port groups will not be formed." % node)
 
-    def check_bond_int_speeds_match(self, node, bond_interfaces):
+    def check_bond_int_speeds_match(self, node, bond_interfaces, sanity):
         # check bond interface speeds match
         if bond_interfaces and self.env.check_interface_errors:
             speeds = {}
             for iface in bond_interfaces:
-                resp, errors = self.env.run_command_on_node(
-                    node, "ethtool %s | grep Speed" % iface)
-                resp = resp.strip()
+                resp = sanity['ethtool:%s' % iface][0].strip()
                 if resp:
                     speeds[iface] = resp
             if len(set(speeds.values())) > 1:
-                print ("Warning: bond interface speeds do not match on node "
-                       "%s. Were the correct interfaces chosen?\nSpeeds: %s"
-                       % (node, speeds))
-
-    def cert_validity_check(self, node):
+                print("Warning: bond interface speeds do not match on node "
+                      "%s. Were the correct interfaces chosen?\nSpeeds: %s"
+                      % (node, speeds))
+
+    def get_keystone_certs(self, probe):
+        resp, errors = probe['keystone_certs']
+        cert_settings = {}
+        for line in resp.splitlines():
+            key, _, value = line.partition('=')
+            cert_settings[key.strip()] = value.strip()
+        certs = (cert_settings.get('ca_certs') or
+                 '/etc/keystone/ssl/certs/ca.pem').split(',')
+        certs.append(cert_settings.get('certfile') or
+                     '/etc/keystone/ssl/certs/signing_cert.pem')
+        return [cert.strip() for cert in certs if cert.strip()]
+
+    def cert_validity_check(self, node, certs, sanity):
         # check for certificates generated in the future (due to clock change)
         # or expired certs
-        certs = []
-        resp, errors = self.env.run_command_on_node(
-            node, ("cat /etc/keystone/keystone.conf | grep -e '^ca_certs' "
-                   "| awk -F '=' '{ print $2 }'"))
-        certs += resp.split(',') if resp else ['/etc/keystone/ssl/certs/ca.pem']
-        resp, errors = self.env.run_command_on_node(
-            node, ("cat /etc/keystone/keystone.conf | grep -e '^certfile' "
-                   "| awk -F '=' '{ print $2 }'"))
-        certs.append(
-            resp if resp else '/etc/keystone/ssl/certs/signing_cert.pem')
+        # openssl verify checks every file in one run. older versions print
+        # 'path: subject' followed by the details on stdout while newer ones
+        # print the details followed by 'error path: verification failed' on
+        # stderr, so lines are attributed to a cert from either end.
+        resp, errors = sanity['certs']
+        results = dict((cert, []) for cert in certs)
+        for output in (resp, errors):
+            owner, lines = None, []
+            for line in output.splitlines():
+                opened = [c for c in certs if line.startswith(c + ':')]
+                closed = [c for c in certs
+                          if line.startswith('error %s:' % c)]
+                if opened:
+                    if owner:
+                        results[owner].extend(lines)
+                    owner, lines = opened[0], [line]
+                elif closed:
+                    results[closed[0]].extend(lines + [line])
+                    owner, lines = None, []
+                else:
+                    lines.append(line)
+            if owner:
+                results[owner].extend(lines)
         for cert in certs:
-            cert = cert.strip()
-            resp, errors = self.env.run_command_on_node(
-                node, ("openssl verify %s" % cert))
+            resp = '\n'.join(results[cert])
             if 'expired' in resp or 'not yet valid' in resp:
-                print ("Warning: the certificate %s being used by keystone is "
-                       "not valid for the current time. If the clocks on the "
-                       "servers are correct, the certificates will need to be "
-                       "deleted and then regenerated using the "
-                       "'keystone-manage pki_setup' command.\n"
-                       "Details: %s" % (cert, resp))
-
-    def check_health_of_bond_interfaces(self, node, bond_interfaces):
+                print("Warning: the certificate %s being used by keystone is "
+                      "not valid for the current time. If the clocks on the "
+                      "servers are correct, the certificates will need to be "
+                      "deleted and then regenerated using the "
+                      "'keystone-manage pki_setup' command.\n"
+                      "Details: %s" % (cert, resp))
+
+    def check_health_of_bond_interfaces(self, node, bond_interfaces, probe):
         for bondint in bond_interfaces:
-            resp, errors = self.env.run_command_on_node(
-                node, "ifconfig %s" % bondint)
+            resp, errors = probe['ifconfig:%s' % bondint]
             if not resp:
                 raise Exception("Error: bond member '%s' on node '%s' was "
                                 "not found.\n%s" % (bondint, node, errors))
@@ -781,42 +1111,33 @@ class ConfigDeployer(object):
                                 % (bondint, node, resp))
             # warn on interface errors
             try:
-                tx = re.findall("TX packets:\d+ errors:(\d+) "
-                                "dropped:\d+ overruns:(\d+) "
-                                "carrier:(\d+)", resp)[0]
-                rx = re.findall("RX packets:\d+ errors:(\d+) "
-                                "dropped:\d+ overruns:(\d+) "
-                                "frame:(\d+)", resp)[0]
+                tx = IFCONFIG_TX_ERRORS_RE.findall(resp)[0]
+                rx = IFCONFIG_RX_ERRORS_RE.findall(resp)[0]
                 if (self.env.check_interface_errors
-                        and any(map(int, rx + tx))):
-                    print ("[Node %s] Warning: errors detected on bond "
-                           "interface %s. Verify cabling and check error "
-                           "rates using ifconfig.\n%s" %
-                           (node, bondint, resp))
-            except:
+                        and any(int(count) for count in rx + tx)):
+                    print("[Node %s] Warning: errors detected on bond "
+                          "interface %s. Verify cabling and check error "
+                          "rates using ifconfig.\n%s" %
+                          (node, bondint, resp))
+            except (IndexError, ValueError):
                 # ignore errors trying to parse
                 pass
 
-    def copy_neutron_files_to_node(self, node):
+    def copy_neutron_files_to_node(self, node, probe):
         # Find where python libs are installed
-        netaddr_path = self.env.get_node_python_package_path(node, 'netaddr')
+        netaddr_path = self.env.parse_python_package_path(
+            node, 'netaddr', *probe['netaddr_path'])
         # we need to replace all of neutron plugins dir in CentOS
         if NEUTRON_TGZ_PATH[self.os_release] and netaddr_path:
             python_lib_dir = "/".join(netaddr_path.split("/")[:-1]) + "/"
             target_neutron_path = python_lib_dir + 'neutron'
-            f = tempfile.NamedTemporaryFile(delete=True)
-            f.write(self.patch_file_cache[NEUTRON_TGZ_PATH[self.os_release][0]])
-            f.flush()
-            nfile = '~/neutron.tar.gz'
-            resp, errors = self.env.copy_file_to_node(node, f.name, nfile)
-            if errors:
-                raise Exception("error pushing neutron to %s:\n%s"
-                                % (node, errors))
+            tarball = self.patch_file_cache[
+                NEUTRON_TGZ_PATH[self.os_release][0]]
             # temp dir to extract to
             extract = "export TGT=$(mktemp -d);"
-            # extract with strip-components to remove the branch dir
-            extract += 'tar --strip-components=1 -xf '
-            extract += '~/neutron.tar.gz -C "$TGT";'
+            # the tarball is streamed in on stdin and extracted with
+            # strip-components to remove the branch dir
+            extract += 'tar --strip-components=1 -xzf - -C "$TGT";'
             # move the extraced plugins to the neutron dir
             extract += 'yes | cp -rfp "$TGT/neutron" "%s/../";' % target_neutron_path
             # grab the commit marker
@@ -825,58 +1146,42 @@ class ConfigDeployer(object):
             # cleanup old pyc files
             extract += 'find "%s" -name "*.pyc" -exec rm -rf {} \;' % target_neutron_path
             resp, errors = self.env.run_command_on_node(
-                node, "bash -c '%s'" % extract)
+                node, "bash -c '%s'" % extract, 180, stdin=tarball)
             if errors:
                 raise Exception("error installing neutron to %s:\n%s"
                                 % (node, errors))
 
-    def patch_horizon_if_installed(self, node):
-        # try to find horizon. locate command isn't available on redhat so
-        # we make a guess at a well-known location in that case.
-        resp, errors = self.env.run_command_on_node(
-            node,
-            ("updatedb 2>/dev/null && "
-             "locate openstack_dashboard/dashboards/admin/dashboard.py "
-             "| grep -v pyc || "
-             "ls /usr/share/openstack-dashboard/openstack_dashboard/"
-             "dashboards/admin/dashboard.py"))
-        if (HORIZON_TGZ_PATH[self.os_release] and not errors and resp.splitlines()
-                and 'openstack_dashboard/dashboards/admin/' in resp.splitlines()[0]):
-            first = resp.splitlines()[0]
-            f = tempfile.NamedTemporaryFile(delete=True)
-            f.write(self.patch_file_cache[HORIZON_TGZ_PATH[self.os_release][0]])
-            f.flush()
-            nfile = '~/horizon.tar.gz'
-            resp, errors = self.env.copy_file_to_node(node, f.name, nfile)
-            if errors:
-                raise Exception("error pushing horizon to %s:\n%s"
-                                % (node, errors))
+    def patch_horizon_if_installed(self, node, probe):
+        resp, errors = probe['horizon_path']
+        lines = resp.splitlines()
+        if (HORIZON_TGZ_PATH[self.os_release] and not errors and lines
+                and 'openstack_dashboard/dashboards/admin/' in lines[0]):
+            first = lines[0]
+            tarball = self.patch_file_cache[
+                HORIZON_TGZ_PATH[self.os_release][0]]
             # make sure horizon can read neutron conf
-            for cf in ['/etc/neutron/neutron.conf', '/etc/neutron/plugin.ini',
-                       '/etc/neutron/plugins/ml2/ml2_conf.ini',
-                       '/etc/neutron/plugins/bigswitch/restproxy.ini']:
-                self.env.run_command_on_node(node, 'chmod +r %s' % cf)
-                self.env.run_command_on_node(
-                    node, 'chmod +x %s' % cf.rsplit('/', 1)[0])
+            conf_files = ['/etc/neutron/neutron.conf',
+                          '/etc/neutron/plugin.ini',
+                          '/etc/neutron/plugins/ml2/ml2_conf.ini',
+                          '/etc/neutron/plugins/bigswitch/restproxy.ini']
+            conf_dirs = []
+            for cf in conf_files:
+                if cf.rsplit('/', 1)[0] not in conf_dirs:
+                    conf_dirs.append(cf.rsplit('/', 1)[0])
+            self.env.run_command_on_node(
+                node, 'chmod +r %s; chmod +x %s'
+                % (' '.join(conf_files), ' '.join(conf_dirs)))
             base_dir = first.split('openstack_dashboard/dashboards/admin/')[0]
             # temp dir to extract to
             extract = "export TGT=$(mktemp -d);"
-            # extract with strip-components to remove the branch dir
-            extract += 'tar --strip-components=1 -xf '
-            extract += '~/horizon.tar.gz -C "$TGT";'
-            for horizon_patch in HORIZON_PATHS_TO_COPY:
-                # remove filename
-                if '/' in horizon_patch:
-                    rel_target_dir = horizon_patch.rsplit('/', 1)[0] + '/'
-                else:
-                    # top level file
-                    rel_target_dir = '/'
-                extract += 'yes | cp -rfp "$TGT/%s" "%s/%s";' % (
-                    horizon_patch, base_dir, rel_target_dir)
+            # the tarball is streamed in on stdin and extracted with
+            # strip-components to remove the branch dir
+            extract += 'tar --strip-components=1 -xzf - -C "$TGT";'
+            extract += HORIZON_COPY_COMMANDS % {'base_dir': base_dir}
             # cleanup old pyc files
             extract += 'find "%s" -name "*.pyc" -exec rm -rf {} \;' % base_dir
             resp, errors = self.env.run_command_on_node(
-                node, "bash -c '%s'" % extract)
+                node, "bash -c '%s'" % extract, 180, stdin=tarball)
             if errors:
                 raise Exception("error installing horizon to %s:\n%s"
                                 % (node, errors))
@@ -886,18 +1191,33 @@ class ConfigDeployer(object):
             # the restarts into the background.
             self.env.run_command_on_node(node, "service httpd restart")
 
-    def get_neutron_connection_string(self, node):
-        neutron_running = self.env.run_command_on_node(
-            node, 'ps -ef | grep neutron-server | grep -v grep')[0].strip()
+    def get_neutron_connection_string(self, probe, sanity):
+        neutron_running = sanity['neutron_server'][0].strip()
         if neutron_running:
-            resp = self.env.run_command_on_node(
-                node, ("grep -R -e '^connection' /etc/neutron/neutron.conf")
-            )[0].strip()
+            resp = probe['neutron_connection'][0].strip()
             if resp:
                 return resp.replace(' ', '')
 
 
+class ManifestTemplate(string.Template):
+    # Substitutes %(name)s placeholders like the % operator but leaves every
+    # other % and $ alone, so the puppet code needs no escaping. The pattern
+    # is compiled once when the class is created.
+    delimiter = '%'
+    pattern = r"""
+    %(?:
+      \((?P<named>[_a-z][_a-z0-9]*)\)s |
+      (?P<escaped>(?!)) |
+      (?P<braced>(?!)) |
+      (?P<invalid>(?!))
+    )
+    """
+
+
 class PuppetTemplate(object):
+    # rendered manifests keyed by the settings they were rendered with. nodes
+    # with the same settings reuse the manifest rendered for the first one.
+    rendered_manifests = {}
 
     def __init__(self, settings):
         self.settings = {
@@ -906,135 +1226,308 @@ class PuppetTemplate(object):
             'bigswitch_serverauth': '', 'network_vlan_ranges': '',
             'physical_bridge': 'br-ovs-bond0', 'bridge_mappings': '',
             'neutron_path': '', 'neutron_restart_refresh_only': '',
-            'offline_mode': '', 'bond_mode': '', 'lldp_advertised_name': ''
+            'offline_mode': '', 'bond_mode': '', 'lldp_advertised_name': '',
+            'use_crudini': False
         }
         for key in settings:
             self.settings[key] = settings[key]
+        # (path, section, setting, value) in the order they were added. value
+        # is None for settings to remove.
+        self.ini_settings = []
 
     def get_string(self):
+        key = frozenset(self.settings.items())
+        manifest = self.rendered_manifests.get(key)
+        if manifest is None:
+            manifest = self.rendered_manifests[key] = self.render()
+        return manifest
+
+    def render(self):
         # inject settings into template
-        manifest = self.main_body % self.settings
+        parts = [self.main_body.substitute(self.settings)]
         if self.settings['neutron_path']:
-            manifest += self.neutron_body % self.settings
-            manifest += self.generate_all_ini_settings()
+            parts.append(self.neutron_body.substitute(self.settings))
+            parts.append(self.neutron_cleanup_body)
+            parts.append(self.generate_all_ini_settings())
         # only setup bond stuff if interfaces are defined
         if self.settings['bond_interfaces']:
-            manifest += self.bond_and_lldpd_configuration
+            parts.append(self.bond_and_lldpd_configuration)
 
-        return manifest
+        return ''.join(parts)
 
     def generate_all_ini_settings(self):
         """ This defines the majority of the ini settings used by puppet """
 
         # make smaller function to take up less space
-        gen_ini = self.generate_ini_setting
-        results = [
-            gen_ini('DEFAULT', 'dhcp_agents_per_network', 2),
-            gen_ini('DEFAULT', 'api_workers', 0),
-            gen_ini('DEFAULT', 'rpc_workers', 0),
-            gen_ini('DEFAULT', 'core_plugin', 'ml2'),
-            # TODO: make this config driven for t6 to enable our l3 plugin
-            gen_ini('DEFAULT', 'service_plugins', 'router'),
-            gen_ini('DEFAULT', 'agent_down_time', '75'),
-            gen_ini('DEFAULT', 'rpc_conn_pool_size', '4'),
-            gen_ini('DEFAULT', 'rpc_thread_pool_size', '4'),
-            gen_ini('DEFAULT', 'allow_automatic_l3agent_failover', 'True'),
-            gen_ini('DATABASE', 'max_overflow', '30'),
-            gen_ini('DATABASE', 'max_pool_size', '15'),
-            gen_ini('AGENT', 'report_interval', '30'),
-            gen_ini('AGENT', 'report_interval', '30',
-                    path='$neutron_conf_path'),
-            gen_ini('AGENT', 'root_helper',
-                    'sudo neutron-rootwrap /etc/neutron/rootwrap.conf',
-                    path='$neutron_conf_path'),
-            gen_ini(
-                'SECURITYGROUP', 'firewall_driver',
-                'neutron.agent.linux.iptables_firewall.OVSHybridIptablesFirewallDriver',
-                path='$neutron_conf_path'),
-            gen_ini('ml2', 'type_drivers', 'vlan',
-                    path='$neutron_conf_path'),
-            gen_ini('ml2', 'tenant_network_types', 'vlan',
-                    path='$neutron_conf_path'),
-            # TODO: change the value of this to 'openvswitch,bsn_ml2' once the
-            # switch to bsnstacklib is done
-            gen_ini('ml2', 'mechanism_drivers', 'openvswitch,bigswitch',
-                    path='$neutron_conf_path'),
-            gen_ini('ml2_type_vlan', 'network_vlan_ranges',
-                    '$network_vlan_ranges', path='$neutron_conf_path'),
-            gen_ini('ovs', 'bridge_mappings', '$ovs_bridge_mappings',
-                    path='$neutron_ovs_conf_path'),
-            gen_ini('ovs', 'network_vlan_ranges', '$network_vlan_ranges',
-                    path='$neutron_ovs_conf_path'),
-            gen_ini('ovs', 'enable_tunneling', 'False',
-                    path='$neutron_ovs_conf_path'),
-            gen_ini('ovs', 'ovs_enable_tunneling', 'False',
-                    path='$neutron_ovs_conf_path'),
-            gen_ini('agent', 'tunnel_types', value='',
-                    path='$neutron_ovs_conf_path'),
-            gen_ini('AGENT', 'tunnel_types', value=None, ensure='absent'),
-            gen_ini('OVS', 'tunnel_bridge', value=None, ensure='absent'),
-            gen_ini('restproxy', 'neutron_id', '$neutron_id',
-                    path='$neutron_conf_path'),
-            gen_ini('restproxy', 'servers', '$bigswitch_servers',
-                    path='$neutron_conf_path'),
-            gen_ini('restproxy', 'server_auth', '$bigswitch_serverauth',
-                    path='$neutron_conf_path'),
-            gen_ini('restproxy', 'auto_sync_on_failure', 'True',
-                    path='$neutron_conf_path'),
-            gen_ini('restproxy', 'consistency_interval', '60',
-                    path='$neutron_conf_path'),
-            gen_ini('restproxy', 'ssl_cert_directory',
-                    '$bigswitch_ssl_cert_directory',
-                    path='$neutron_conf_path'),
-
-            # TODO: make this dependent on T6 so it will use IVSInterfaceDriver
-            # instead
-            gen_ini(
-                'DEFAULT', 'interface_driver',
-                'neutron.agent.linux.interface.OVSInterfaceDriver',
-                path='$neutron_dhcp_conf_path'),
-            # don't specify bridge for external networks so they are treated like
-            # a normal VLAN network
-            gen_ini(
-                'DEFAULT', 'external_network_bridge', '',
-                path='$neutron_l3_conf_path'),
-            gen_ini(
-                'DEFAULT', 'handle_internal_only_routers', 'True',
-                path='$neutron_l3_conf_path'),
-        ]
-        return "\n".join(results)
-
-    def generate_ini_setting(self, section, setting, value,
-                             path='$neutron_main_conf_path', ensure='present',
-                             notify="Exec['restartneutronservices']",
-                             require="File[$conf_dirs]"):
-        # Unfortunately ini_setting is case sensitive for sections and
+        add_ini = self.add_ini_setting
+        add_ini('DEFAULT', 'dhcp_agents_per_network', 2)
+        add_ini('DEFAULT', 'api_workers', 0)
+        add_ini('DEFAULT', 'rpc_workers', 0)
+        add_ini('DEFAULT', 'core_plugin', 'ml2')
+        # TODO: make this config driven for t6 to enable our l3 plugin
+        add_ini('DEFAULT', 'service_plugins', 'router')
+        add_ini('DEFAULT', 'agent_down_time', '75')
+        add_ini('DEFAULT', 'rpc_conn_pool_size', '4')
+        add_ini('DEFAULT', 'rpc_thread_pool_size', '4')
+        add_ini('DEFAULT', 'allow_automatic_l3agent_failover', 'True')
+        add_ini('DATABASE', 'max_overflow', '30')
+        add_ini('DATABASE', 'max_pool_size', '15')
+        add_ini('AGENT', 'report_interval', '30')
+        add_ini('AGENT', 'report_interval', '30',
+                path='$neutron_conf_path')
+        add_ini('AGENT', 'root_helper',
+                'sudo neutron-rootwrap /etc/neutron/rootwrap.conf',
+                path='$neutron_conf_path')
+        add_ini(
+            'SECURITYGROUP', 'firewall_driver',
+            'neutron.agent.linux.iptables_firewall.OVSHybridIptablesFirewallDriver',
+            path='$neutron_conf_path')
+        add_ini('ml2', 'type_drivers', 'vlan',
+                path='$neutron_conf_path')
+        add_ini('ml2', 'tenant_network_types', 'vlan',
+                path='$neutron_conf_path')
+        # TODO: change the value of this to 'openvswitch,bsn_ml2' once the
+        # switch to bsnstacklib is done
+        add_ini('ml2', 'mechanism_drivers', 'openvswitch,bigswitch',
+                path='$neutron_conf_path')
+        add_ini('ml2_type_vlan', 'network_vlan_ranges',
+                '$network_vlan_ranges', path='$neutron_conf_path')
+        add_ini('ovs', 'bridge_mappings', '$ovs_bridge_mappings',
+                path='$neutron_ovs_conf_path')
+        add_ini('ovs', 'network_vlan_ranges', '$network_vlan_ranges',
+                path='$neutron_ovs_conf_path')
+        add_ini('ovs', 'enable_tunneling', 'False',
+                path='$neutron_ovs_conf_path')
+        add_ini('ovs', 'ovs_enable_tunneling', 'False',
+                path='$neutron_ovs_conf_path')
+        add_ini('agent', 'tunnel_types', value='',
+                path='$neutron_ovs_conf_path')
+        add_ini('AGENT', 'tunnel_types', value=None, ensure='absent')
+        add_ini('OVS', 'tunnel_bridge', value=None, ensure='absent')
+        add_ini('restproxy', 'neutron_id', '$neutron_id',
+                path='$neutron_conf_path')
+        add_ini('restproxy', 'servers', '$bigswitch_servers',
+                path='$neutron_conf_path')
+        add_ini('restproxy', 'server_auth', '$bigswitch_serverauth',
+                path='$neutron_conf_path')
+        add_ini('restproxy', 'auto_sync_on_failure', 'True',
+                path='$neutron_conf_path')
+        add_ini('restproxy', 'consistency_interval', '60',
+                path='$neutron_conf_path')
+        add_ini('restproxy', 'ssl_cert_directory',
+                '$bigswitch_ssl_cert_directory',
+                path='$neutron_conf_path')
+
+        # TODO: make this dependent on T6 so it will use IVSInterfaceDriver
+        # instead
+        add_ini(
+            'DEFAULT', 'interface_driver',
+            'neutron.agent.linux.interface.OVSInterfaceDriver',
+            path='$neutron_dhcp_conf_path')
+        # don't specify bridge for external networks so they are treated like
+        # a normal VLAN network
+        add_ini(
+            'DEFAULT', 'external_network_bridge', '',
+            path='$neutron_l3_conf_path')
+        add_ini(
+            'DEFAULT', 'handle_internal_only_routers', 'True',
+            path='$neutron_l3_conf_path')
+        if self.settings['use_crudini']:
+            return self.generate_ini_files()
+        return self.generate_ini_settings()
+
+    def add_ini_setting(self, section, setting, value,
+                        path='$neutron_main_conf_path', ensure='present'):
+        # Unfortunately ini files are case sensitive for sections and
         # openstack is not. That means we have to set both uppercase and
         # lowercase sections because we don't know which one the previous tool
-        # might have used.
+        # might have used. DEFAULT is only set once since ini parsers treat it
+        # specially and crudini rejects a section named 'default'.
+        names = [section.upper()]
+        if section.upper() != 'DEFAULT':
+            names.insert(0, section.lower())
+        for name in names:
+            self.ini_settings.append(
+                (path, name, setting, value if ensure == 'present' else None))
+
+    def group_ini_settings(self):
+        # Returns [(path, [(section, [(setting, value)])])] keeping the order
+        # the files, sections and settings were first added in.
+        files = []
+        sections_by_path = {}
+        values_by_section = {}
+        for path, section, setting, value in self.ini_settings:
+            if path not in sections_by_path:
+                sections_by_path[path] = []
+                files.append((path, sections_by_path[path]))
+            if (path, section) not in values_by_section:
+                values_by_section[(path, section)] = []
+                sections_by_path[path].append(
+                    (section, values_by_section[(path, section)]))
+            values_by_section[(path, section)].append((setting, value))
+        return files
+
+    def generate_ini_files(self):
+        # Each ini file gets a single settings file that is merged into it by
+        # one exec, rather than an ini_setting resource per value that each
+        # parse and rewrite the same file.
+        body = [self.ini_apply_body]
+        for path, sections in self.group_ini_settings():
+            ident = re.sub(r'\W+', '', path)
+            settings_file = '/var/lib/bigpatch/%s.ini' % ident
+            contents = []
+            removals = []
+            for section, values in sections:
+                removals.extend('%s:%s' % (section, setting)
+                                for setting, value in values
+                                if value is None)
+                present = ['%s = %s' % (setting, value)
+                           for setting, value in values
+                           if value is not None]
+                if present:
+                    contents.append('[%s]' % section)
+                    contents.extend(present)
+            args = ' '.join([path, settings_file] + removals)
+            body.append('file{"ini_settings_%s":' % ident)
+            body.append('  ensure  => file,')
+            body.append('  path    => "%s",' % settings_file)
+            body.append('  content => "%s\n",' % '\n'.join(contents))
+            body.append("  require => File['bigpatch_dir'],")
+            body.append('}')
+            body.append('exec{"ini_%s":' % ident)
+            body.append('  command => "%s %s",' % (INI_APPLY_SCRIPT, args))
+            body.append('  unless  => "%s --check %s",'
+                        % (INI_APPLY_SCRIPT, args))
+            body.append("  notify  => Exec['restartneutronservices'],")
+            body.append('  require => [File[$conf_dirs], '
+                        'File["ini_settings_%s"], File[\'ini_apply\']],'
+                        % ident)
+            body.append('  path    => $binpath,')
+            body.append('}')
+        return "\n".join(body)
+
+    def generate_ini_settings(self):
+        # Fallback for nodes without crudini, which we don't install since it
+        # needs a network repo. Every value gets its own ini_setting resource
+        # from the inifile module.
         body = []
-        ident = re.sub(r'\W+', '', path + setting)
-        body.append('ini_setting{"ini_%s":' % ('lower' + ident))
-        body.append('  path    => "%s",' % path)
-        body.append('  section => "%s",' % section.lower())
-        body.append('  setting => "%s",' % setting)
-        if value is not None:
-            body.append('  value   => "%s",' % value)
-        if ensure:
-            body.append('  ensure  => %s,' % ensure)
-        if notify:
-            body.append('  notify  => %s,' % notify)
-        if require:
-            body.append('  require => %s,' % require)
-        body.append('}')
-        lower_case = "\n".join(body)
-        # swap out the idenifier and the section with the uppercase version
-        body[0] = 'ini_setting{"ini_%s":' % ('upper' + ident)
-        body[2] = '  section => "%s",' % section.upper()
-        upper_case = "\n".join(body)
-        return "\n".join([lower_case, upper_case])
-
-    main_body = r"""
+        for path, section, setting, value in self.ini_settings:
+            ident = re.sub(r'\W+', '', path + section + setting)
+            body.append('ini_setting{"ini_%s":' % ident)
+            body.append('  path    => "%s",' % path)
+            body.append('  section => "%s",' % section)
+            body.append('  setting => "%s",' % setting)
+            if value is None:
+                body.append('  ensure  => absent,')
+            else:
+                body.append('  value   => "%s",' % value)
+                body.append('  ensure  => present,')
+            body.append("  notify  => Exec['restartneutronservices'],")
+            body.append('  require => File[$conf_dirs],')
+            body.append('}')
+        return "\n".join(body)
+
+    ini_apply_body = r"""
+# merges a file of settings into an ini file and removes each section:key pair
+# given after it. the file is only rewritten if something changed. with
+# --check nothing is written and the exit code tells whether the ini file
+# already has all of the changes.
+file{'ini_apply':
+    ensure  => file,
+    mode    => 0755,
+    path    => '/var/lib/bigpatch/ini_apply.sh',
+    require => File['bigpatch_dir'],
+    content => '#!/bin/bash
+check=0
+if [ "$1" = "--check" ]; then
+    check=1
+    shift
+fi
+target=$1
+settings=$2
+shift 2
+work=$(mktemp)
+trap "rm -f $work" EXIT
+[ -f "$target" ] && cat "$target" > "$work"
+crudini --merge "$work" < "$settings" || exit 1
+for item in "$@"; do
+    crudini --del "$work" "${item%%:*}" "${item#*:}" || exit 1
+done
+cmp -s "$target" "$work" && exit 0
+[ $check = 1 ] && exit 1
+# write through the existing file to keep its owner, mode and any symlink
+cat "$work" > "$target"
+',
+}
+"""
+    neutron_cleanup_body = r"""
+# runs mysql on the neutron database. the credentials are read from
+# neutron.conf when it runs and passed in a private defaults file, so they
+# never appear in this manifest, the puppet log or the process list. fails
+# if neutron isn't using mysql.
+file{'neutron_mysql':
+    ensure  => file,
+    mode    => 0700,
+    path    => '/var/lib/bigpatch/neutron_mysql.sh',
+    require => File['bigpatch_dir'],
+    content => '#!/bin/bash
+defaults=$(mktemp)
+trap "rm -f $defaults" EXIT
+python - "$defaults" <<"PY" || exit 1
+import sys, urllib, urlparse
+for line in open("/etc/neutron/neutron.conf"):
+    key, sep, value = line.partition("=")
+    if sep and key.strip() == "connection":
+        break
+else:
+    sys.exit("no database connection in neutron.conf")
+url = urlparse.urlparse(value.strip())
+database = url.path.strip("/")
+if not url.scheme.startswith("mysql") or not database:
+    sys.exit("neutron is not using a mysql database")
+# the user and password are url encoded like sqlalchemy expects
+options = [("user", urllib.unquote(url.username or "")),
+           ("password", urllib.unquote(url.password or "")),
+           ("host", url.hostname), ("port", url.port),
+           ("database", database)]
+with open(sys.argv[1], "w") as fh:
+    fh.write("[mysql]\n")
+    for name, value in options:
+        if value:
+            value = str(value).replace(chr(92), chr(92) * 2)
+            fh.write("%s = \"%s\"\n" % (name, value))
+PY
+mysql --defaults-extra-file="$defaults" "$@"
+',
+}
+$MYSQL_COM = '/var/lib/bigpatch/neutron_mysql.sh'
+exec {"cleanup_neutron":
+  # skipped unless some network has no vlan segment. orphaned ports, routers
+  # and floating ips left behind otherwise are only removed on those runs.
+  onlyif => ["which mysql", "$MYSQL_COM -N -e \"SELECT COUNT(*) FROM networks n LEFT JOIN ml2_network_segments s ON s.network_id = n.id AND s.network_type = 'vlan' WHERE s.network_id IS NULL\" | grep -qv '^0\$'"],
+  path => $binpath,
+  # all or nothing: mysql stops at the first failed statement and the open
+  # transaction is rolled back when the session ends, so a failure leaves
+  # every row in place and is reported as an error instead of half applied
+  command => "$MYSQL_COM <<'SQL' || { echo 'neutron cleanup failed and was rolled back, nothing was deleted' >&2; exit 1; }
+CREATE TEMPORARY TABLE vlan_networks (PRIMARY KEY (network_id)) SELECT DISTINCT network_id FROM ml2_network_segments WHERE network_type = 'vlan';
+START TRANSACTION;
+DELETE p, f FROM ports p INNER JOIN floatingips f ON f.floating_port_id = p.id LEFT JOIN vlan_networks v ON v.network_id = p.network_id WHERE v.network_id IS NULL;
+DELETE p, r FROM ports p INNER JOIN routers r ON r.gw_port_id = p.id LEFT JOIN vlan_networks v ON v.network_id = p.network_id WHERE v.network_id IS NULL;
+DELETE p FROM ports p LEFT JOIN vlan_networks v ON v.network_id = p.network_id LEFT JOIN networks n ON n.id = p.network_id WHERE v.network_id IS NULL OR n.id IS NULL;
+DELETE sn FROM subnets sn LEFT JOIN vlan_networks v ON v.network_id = sn.network_id LEFT JOIN networks n ON n.id = sn.network_id WHERE sn.network_id IS NOT NULL AND (v.network_id IS NULL OR n.id IS NULL);
+DELETE n FROM networks n LEFT JOIN vlan_networks v ON v.network_id = n.id WHERE v.network_id IS NULL;
+DELETE r FROM routers r LEFT JOIN ports p ON p.id = r.gw_port_id WHERE p.id IS NULL AND r.gw_port_id IS NOT NULL;
+DELETE f FROM floatingips f LEFT JOIN ports fp ON fp.id = f.floating_port_id LEFT JOIN ports xp ON xp.id = f.fixed_port_id WHERE fp.id IS NULL OR (xp.id IS NULL AND f.fixed_port_id IS NOT NULL);
+COMMIT;
+DROP TEMPORARY TABLE vlan_networks;
+SQL
+",
+  require => File['neutron_mysql'],
+}
+"""  # noqa
+
+    main_body = ManifestTemplate(r"""
 # all of these values are set by the puppet template class above
 $neutron_id = '%(neutron_id)s'
 $bigswitch_serverauth = '%(bigswitch_serverauth)s'
@@ -1056,8 +1549,8 @@ $lldp_advertised_name = '%(lldp_advertised_name)s'
 
 # all of the exec statements use this path
 $binpath = "/usr/local/bin/:/bin/:/usr/bin:/usr/sbin:/usr/local/sbin:/sbin"
-"""  # noqa
-    neutron_body = r'''
+""")  # noqa
+    neutron_body = ManifestTemplate(r'''
 if $operatingsystem == 'Ubuntu'{
     $neutron_conf_path = "/etc/neutron/plugins/ml2/ml2_conf.ini"
 }
@@ -1076,11 +1569,17 @@ $neutron_dhcp_conf_path = '/etc/neutron/dhcp_agent.ini'
 $neutron_main_conf_path = "/etc/neutron/neutron.conf"
 $bigswitch_ssl_cert_directory = '/etc/neutron/plugins/ml2/ssl'
 
+# holds the helper scripts and settings files used below
+file{'bigpatch_dir':
+    ensure => directory,
+    path   => '/var/lib/bigpatch',
+}
+
 
 # stop neutron server and start it only if there is an SQL connection string defined
 exec{"neutronserverrestart":
     refreshonly => true,
-    command => 'bash -c \'grep -R "connection\s*=" /etc/neutron/* | grep -v "#" && service neutron-server restart || service neutron-server stop ||:\'',
+    command => 'bash -c \'grep -Rqs "^[^#]*connection\s*=" /etc/neutron/ && service neutron-server restart || service neutron-server stop ||:\'',
     path    => $binpath,
 }
 if $operatingsystem == 'Ubuntu' {
@@ -1109,7 +1608,7 @@ exec{"restartneutronservices":
 # it may no longer be necessary on RHEL 7
 exec{"checkagent":
     refreshonly => true,
-    command => "[ $(ps -ef | grep openvswitch-agent | wc -l) -eq 0 ] && service neutron-openvswitch-agent restart ||:;",
+    command => "pgrep -f '[o]penvswitch-agent' >/dev/null || service neutron-openvswitch-agent restart ||:;",
     path    => $binpath,
 }
 exec{"neutronl3restart":
@@ -1234,26 +1733,6 @@ if ($operatingsystem == 'CentOS') and ($operatingsystemrelease =~ /^6.*/) {
     }
 }
 
-$MYSQL_USER='cat /etc/neutron/neutron.conf | grep "mysql://" | grep -v "#" | awk -F "//" \'{ print $2 }\' | awk -F ":" \'{ print $1 }\''
-$MYSQL_PASS='cat /etc/neutron/neutron.conf | grep "mysql://" | grep -v "#" | awk -F "//" \'{ print $2 }\' | awk -F ":" \'{ print $2 }\' | awk -F "@" \'{ print $1 }\''
-$MYSQL_HOST='cat /etc/neutron/neutron.conf | grep "mysql://" | grep -v "#" | awk -F "//" \'{ print $2 }\' | awk -F "@" \'{ print $2 }\' | awk -F "/" \'{ print $1 }\' | awk -F ":" \'{ print $1 }\''
-$MYSQL_DB='cat /etc/neutron/neutron.conf | grep "mysql://" | grep -v "#" | awk -F "//" \'{ print $2 }\' | awk -F "@" \'{ print $2 }\' | awk -F "/" \'{ print $2 }\' | awk -F "?" \'{ print $1 }\''
-$MYSQL_COM="mysql -u `$MYSQL_USER` -p`$MYSQL_PASS` -h `$MYSQL_HOST` `$MYSQL_DB`"
-exec {"cleanup_neutron":
-  onlyif => ["which mysql", "echo 'show tables' | $MYSQL_COM"],
-  path => $binpath,
-  command => "echo 'delete ports, floatingips from ports INNER JOIN floatingips on floatingips.floating_port_id = ports.id where ports.network_id NOT IN (select network_id from ml2_network_segments where network_type=\"vlan\");' | $MYSQL_COM;
-              echo 'delete ports, routers from ports INNER JOIN routers on routers.gw_port_id = ports.id where ports.network_id NOT IN (select network_id from ml2_network_segments where network_type=\"vlan\");' | $MYSQL_COM;
-              echo 'delete from ports where network_id NOT in (select network_id from ml2_network_segments where network_type=\"vlan\");' | $MYSQL_COM;
-              echo 'delete from subnets where network_id NOT IN (select network_id from ml2_network_segments where network_type=\"vlan\");' | $MYSQL_COM;
-              echo 'delete from networks where id NOT IN (select network_id from ml2_network_segments where network_type=\"vlan\");' | $MYSQL_COM;
-              echo 'delete from ports where network_id NOT IN (select network_id from networks);' | $MYSQL_COM;
-              echo 'delete from routers where gw_port_id NOT IN (select id from ports);' | $MYSQL_COM;
-              echo 'delete from floatingips where floating_port_id NOT IN (select id from ports);' | $MYSQL_COM;
-              echo 'delete from floatingips where fixed_port_id NOT IN (select id from ports);' | $MYSQL_COM;
-              echo 'delete from subnets where network_id NOT IN (select id from networks);' | $MYSQL_COM;
-             "
-}
 if $operatingsystem == 'CentOS' or $operatingsystem == 'RedHat'{
     file{'selinux_allow_certs':
        ensure => file,
@@ -1284,7 +1763,7 @@ allow neutron_t etc_t:file create;
         path    => $binpath,
     }
 }
-'''  # noqa
+''')  # noqa
 
     bond_and_lldpd_configuration = r'''
 exec {"loadbond":
@@ -1352,8 +1831,7 @@ auto bond0
        refreshonly => true,
        require => [Exec['loadbond'], File['bondmembers'], Exec['deleteovsbond'], Exec['lldpdinstall']],
        command => "bash -c '
-         sed -i s/auto bond0//g /etc/network/interfaces
-         sed -i s/iface bond0/iface bond0old/g /etc/network/interfaces
+         sed -i -e \"/^[[:space:]]*auto bond0[[:space:]]*\$/d\" -e \"/^[[:space:]]*iface bond0 /s/bond0 /bond0old /\" /etc/network/interfaces
          # 1404+ doesnt allow init script full network restart
          if [[ \$(lsb_release -r | tr -d -c 0-9) = 14* ]]; then
              ifdown ${bond_int0}
@@ -1428,14 +1906,14 @@ lldpcli \$@
 if $operatingsystem == 'RedHat' {
     if ! $offline_mode {
         exec {'lldpdinstall':
-           onlyif => "yum --version && (! ls /etc/init.d/lldpd)",
+           onlyif => "yum --version && (! ls /etc/init.d/lldpd) && ! rpm -q lldpd",
            command => 'bash -c \'
                export baseurl="http://download.opensuse.org/repositories/home:/vbernat/";
-               [[ $(cat /etc/redhat-release | tr -d -c 0-9) =~ ^6 ]] && export url="${baseurl}/RedHat_RHEL-6/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
-               [[ $(cat /etc/redhat-release | tr -d -c 0-9) =~ ^7 ]] && export url="${baseurl}/RHEL_7/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
+               [[ $(tr -d -c 0-9 < /etc/redhat-release) =~ ^6 ]] && export url="${baseurl}/RedHat_RHEL-6/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
+               [[ $(tr -d -c 0-9 < /etc/redhat-release) =~ ^7 ]] && export url="${baseurl}/RHEL_7/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
                cd /root/;
-               wget "$url" -O lldpd.rpm;
-               rpm -i lldpd.rpm\'',
+               [ -s lldpd.rpm ] || wget "$url" -O lldpd.rpm || rm -f lldpd.rpm;
+               rpm -i lldpd.rpm || { rm -f lldpd.rpm; false; }\'',
            path    => $binpath,
            notify => File['redhatlldpdconfig'],
         }
@@ -1516,14 +1994,14 @@ BONDING_OPTS='mode=${bond_mode} miimon=50 updelay=${bond_updelay} xmit_hash_poli
 if $operatingsystem == 'CentOS' {
     if ! $offline_mode {
         exec {'lldpdinstall':
-           onlyif => "yum --version && (! ls /etc/init.d/lldpd)",
+           onlyif => "yum --version && (! ls /etc/init.d/lldpd) && ! rpm -q lldpd",
            command => 'bash -c \'
                export baseurl="http://download.opensuse.org/repositories/home:/vbernat/";
-               [[ $(cat /etc/redhat-release | tr -d -c 0-9) =~ ^6 ]] && export url="${baseurl}/CentOS_CentOS-6/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
-               [[ $(cat /etc/redhat-release | tr -d -c 0-9) =~ ^7 ]] && export url="${baseurl}/CentOS_7/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
+               [[ $(tr -d -c 0-9 < /etc/redhat-release) =~ ^6 ]] && export url="${baseurl}/CentOS_CentOS-6/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
+               [[ $(tr -d -c 0-9 < /etc/redhat-release) =~ ^7 ]] && export url="${baseurl}/CentOS_7/x86_64/lldpd-0.7.14-1.1.x86_64.rpm";
                cd /root/;
-               wget "$url" -O lldpd.rpm;
-               rpm -i lldpd.rpm\'',
+               [ -s lldpd.rpm ] || wget "$url" -O lldpd.rpm || rm -f lldpd.rpm;
+               rpm -i lldpd.rpm || { rm -f lldpd.rpm; false; }\'',
            path    => $binpath,
            notify => File['centoslldpdconfig'],
         }
@@ -1612,7 +2090,7 @@ file{'lldpclioptions':
 '''  # noqa
 
 if __name__ == '__main__':
-    print "Big Patch Version %s:%s" % (BRANCH_ID, SCRIPT_VERSION)
+    print("Big Patch Version %s:%s" % (BRANCH_ID, SCRIPT_VERSION))
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group()
     parser.add_argument("-r", "--openstack-release", required=True,
@@ -1648,7 +2126,11 @@ if __name__ == '__main__':
                         help="Suppress warnings about interface errors.")
     parser.add_argument('--debug', action='store_true',
                         help="Show commands being executed on nodes.")
+    parser.add_argument('--concurrency', type=int, default=MAX_THREADS,
+                        help="Maximum number of nodes to deploy to at the "
+                             "same time. Default is %s." % MAX_THREADS)
     parser.add_argument("--bond-mode", default="xor",
+                        choices=sorted(BOND_MODES),
                         help="Mode to set on node bonds (xor or round-robin). "
                              "(Default is xor.)")
     remote = parser.add_argument_group('remote-deployment')
@@ -1682,15 +2164,17 @@ if __name__ == '__main__':
                             "(e.g. eth1,eth2)")
     args = parser.parse_args()
     if args.specific_nodes:
-        specific_nodes = args.specific_nodes.split(',')
+        specific_nodes = frozenset(args.specific_nodes.split(','))
     else:
-        specific_nodes = []
+        specific_nodes = frozenset()
     if args.skip_nodes:
-        skip_nodes = args.skip_nodes.split(',')
+        skip_nodes = frozenset(args.skip_nodes.split(','))
     else:
-        skip_nodes = []
+        skip_nodes = frozenset()
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1.')
     neutron_id = args.neutron_cluster_name
-    if not re.compile("^([A-Za-z0-9\.\-\_]+)*$").match(neutron_id):
+    if not NEUTRON_ID_RE.match(neutron_id):
         parser.error('--neutron-cluster-name can only contain alphanumeric '
                      'characters, hypens and underscores.')
     if args.fuel_environment:
@@ -1699,9 +2183,11 @@ if __name__ == '__main__':
                                       skip_nodes=skip_nodes,
                                       specific_nodes=specific_nodes)
     elif args.config_file:
-        environment = ConfigEnvironment(args.config_file.read(),
-                                        skip_nodes=skip_nodes,
-                                        specific_nodes=specific_nodes)
+        # the file is only needed while it is parsed
+        with args.config_file:
+            environment = ConfigEnvironment(args.config_file,
+                                            skip_nodes=skip_nodes,
+                                            specific_nodes=specific_nodes)
     elif args.stand_alone:
         if not args.network_vlan_ranges:
             parser.error('--network-vlan-ranges is required when using '
@@ -1723,12 +2209,8 @@ if __name__ == '__main__':
                      'file, or standalone mode.')
     if not args.stand_alone:
         environment.ssh_user = args.ssh_user
-        environment.ssh_password = args.ssh_password
-    allowed_bond_modes = {'xor': 2, 'round-robin': 0}
-    if args.bond_mode not in allowed_bond_modes:
-        parser.error('Unsupported bond mode: "%s". Supported modes: "%s"'
-                     % (args.bond_mode, allowed_bond_modes))
-    environment.bond_mode = allowed_bond_modes[args.bond_mode]
+        environment.set_ssh_password(args.ssh_password)
+    environment.bond_mode = BOND_MODES[args.bond_mode]
     environment.debug = args.debug
     environment.set_bigswitch_servers(args.controllers)
     environment.set_bigswitch_auth(args.controller_auth)
@@ -1740,5 +2222,6 @@ if __name__ == '__main__':
         environment.check_interface_errors = False
     deployer = ConfigDeployer(environment,
                               patch_python_files=not args.skip_file_patching,
-                              openstack_release=args.openstack_release)
+                              openstack_release=args.openstack_release,
+                              concurrency=args.concurrency)
     deployer.deploy_to_all()